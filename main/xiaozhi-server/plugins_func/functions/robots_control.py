@@ -1,12 +1,16 @@
-from typing import Literal, Any, Dict
+from typing import Literal, Any, Dict, Union
 from plugins_func.register import register_function, ToolType, ActionResponse, Action
 import paho.mqtt.client as mqtt
 from config.logger import setup_logging
 import uuid
+import threading
+import time
+import socket
 
 # 日志配置
 TAG = __name__
 logger = setup_logging()
+log = logger.bind(tag=TAG)
 
 # 动作类型定义
 RobotAction = Literal[
@@ -14,97 +18,193 @@ RobotAction = Literal[
     'hello', 'omni_walk', 'moonwalk_L', 'dance', 'up_down',
     'push_up', 'front_back', 'wave_hand', 'scared'
 ]
-ROBOT_ACTIONS = set(RobotAction.__args__)
+ROBOT_ACTIONS = frozenset(RobotAction.__args__)
+# 预先编码的指令报文，发布时无需再做str到bytes的转换；send_action_nowait以此校验动作指令是否合法
+_ACTION_BYTES = {a: a.encode('ascii') for a in ROBOT_ACTIONS}
+# 预先生成的指令成功返回结果，仅用于查表，不参与校验
+_SUCCESS_MSGS = {a: f"SUCCESS:{a}命令执行成功" for a in ROBOT_ACTIONS}
+_INVALID_MSG = "ERROR:无效的动作指令"
+# 机器人ID对应的订阅主题，ID最大为3
+ROBOT_TOPICS = {rid: f"esp32/robot{rid}/sub" for rid in (1, 2, 3)}
+# 全部机器人共用的广播主题，需固件同时订阅自身主题和该主题，通过mqtt_broadcast开启
+ROBOT_BROADCAST_TOPIC = "esp32/robot/all/sub"
 
 class RobotController:
     _instance = None
-    _lock = None  # 不再需要asyncio.Lock
+    _lock = threading.Lock()  # 保护单例创建与重新初始化
     _connected_controller = None  # 存储已连接的控制器实例
 
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
-            cls._instance = object.__new__(cls)
+            with cls._lock:
+                if not cls._instance:
+                    cls._instance = object.__new__(cls)
         return cls._instance
 
     """MQTT机器人控制核心类（同步实现）"""
     def __init__(self,
-                 client_id: str = "robot_client",
+                 client_id: str = None,
                  mqtt_host: str = "127.0.0.1",
                  mqtt_port: int = 1883,  # 修改为标准端口
                  mqtt_user: str = None,
-                 mqtt_pass: str = None) -> None:
-        logger.bind(tag=TAG).info("初始化MQTT机器人控制核心类（同步版）")
-
-        if getattr(self, '_initialized', False):
+                 mqtt_pass: str = None,
+                 keepalive: int = 30) -> None:
+        # 单例已初始化且连接配置未变化时直接返回，跳过所有初始化工作
+        cfg_key = (client_id, mqtt_host, mqtt_port, mqtt_user, mqtt_pass, keepalive)
+        if getattr(self, '_initialized', False) and cfg_key == self._cfg_key:
             return
 
-        self._is_connected = False
-        self._initialized = False
-        self.mqtt_host = mqtt_host
-        self.mqtt_port = mqtt_port
-        self.mqtt_user = mqtt_user
-        self.mqtt_pass = mqtt_pass
+        # 加锁后再次检查，避免并发调用重复创建客户端
+        with self._lock:
+            if getattr(self, '_initialized', False):
+                if cfg_key == self._cfg_key:
+                    return
+                log.info("MQTT连接配置已变更，重新连接")
+                self._initialized = False
+            # 无论之前是否初始化成功，都先停止旧客户端，避免其网络线程残留
+            if getattr(self, 'client', None) is not None:
+                self.disconnect()
+
+            log.info("初始化MQTT机器人控制核心类（同步版）")
+            self._is_connected = False
+            self._cfg_key = cfg_key
+            self.mqtt_host = mqtt_host
+            self.mqtt_port = mqtt_port
+            self.mqtt_user = mqtt_user
+            self.mqtt_pass = mqtt_pass
 
-        self.client_id = f"robot_{uuid.uuid4()}"
-        self.client = mqtt.Client(self.client_id)
+            # 未配置client_id时才生成随机ID，生成后随单例复用
+            self.client_id = client_id or f"robot_{uuid.uuid4()}"
+            self.client = mqtt.Client(self.client_id)
+            # 关闭paho内部日志，避免每个报文都格式化调试信息
+            self.client.disable_logger()
+            # 放宽QoS 1的在途消息上限，默认20条会限制发送速率
+            self.client.max_inflight_messages_set(100)
 
-        if mqtt_user and mqtt_pass:
-            logger.bind(tag=TAG).info("使用MQTT认证")
-            self.client.username_pw_set(mqtt_user, mqtt_pass)
+            if mqtt_user and mqtt_pass:
+                log.info("使用MQTT认证")
+                self.client.username_pw_set(mqtt_user, mqtt_pass)
 
-        self.client.on_connect = self._on_connect
-        self.client.on_disconnect = self._on_disconnect
+            self.client.on_connect = self._on_connect
+            self.client.on_disconnect = self._on_disconnect
+            # 断线后由paho网络线程按1~16秒退避自动重连
+            self.client.reconnect_delay_set(min_delay=1, max_delay=16)
+            # 收到CONNACK后由_on_connect置位，避免轮询等待
+            self._connect_event = threading.Event()
+            self._loop_started = False
 
-        try:
-            logger.bind(tag=TAG).info(f"连接MQTT服务器 {mqtt_host}:{mqtt_port}")
-            self.client.connect(mqtt_host, mqtt_port)
-            self.client.loop_start()
-            import time
-            for _ in range(50):
-                if self._is_connected:
-                    break
-                time.sleep(0.1)
-            self._initialized = True
-            logger.bind(tag=TAG).info(f"MQTT初始化完成:{getattr(self, '_initialized', False)}")
-        except Exception as e:
-            logger.bind(tag=TAG).error(f"MQTT连接失败: {str(e)}")
+            try:
+                log.info(f"连接MQTT服务器 {mqtt_host}:{mqtt_port}")
+                # 定期发送PINGREQ，防止空闲连接被NAT/防火墙断开
+                self.client.connect(mqtt_host, mqtt_port, keepalive=keepalive)
+                self.client.loop_start()
+                self._loop_started = True
+                self._connect_event.wait(timeout=5.0)
+                self._initialized = True
+                log.info(f"MQTT初始化完成:{getattr(self, '_initialized', False)}")
+            except Exception as e:
+                log.error(f"MQTT连接失败: {str(e)}")
 
     def _on_connect(self, client: mqtt.Client, userdata: Any, flags: Dict, rc: int):
-        logger.bind(tag=TAG).info(f"MQTT连接状态: {mqtt.connack_string(rc)}")
+        log.info(f"MQTT连接状态: {mqtt.connack_string(rc)}")
         self._is_connected = rc == 0
+        if rc == 0:
+            # 关闭Nagle算法，避免短指令报文被合并延迟发送
+            try:
+                client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception as e:
+                log.error(f"设置TCP_NODELAY失败: {str(e)}")
+        # 收到任何CONNACK都结束等待，连接是否成功以_is_connected为准
+        self._connect_event.set()
 
     def _on_disconnect(self, client: mqtt.Client, userdata: Any, rc: int):
-        logger.bind(tag=TAG).error(f"MQTT断开连接: {mqtt.connack_string(rc)} (代码:{rc})")
+        log.error(f"MQTT断开连接: {mqtt.connack_string(rc)} (代码:{rc})")
         self._is_connected = False
+        self._connect_event.clear()
+
+    def ensure_connected(self, timeout: float = 1.0) -> bool:
+        """连接已断开时等待重连完成，返回当前是否已连接"""
+        if self._is_connected:
+            return True
+        if not self._loop_started:
+            # 网络线程未运行时才自行重连，并启动网络线程接管后续连接
+            with self._lock:
+                if not self._loop_started:
+                    log.info("MQTT未连接，尝试重连")
+                    try:
+                        self.client.reconnect()
+                        self.client.loop_start()
+                        self._loop_started = True
+                        self._initialized = True
+                    except Exception as e:
+                        log.error(f"MQTT重连失败: {str(e)}")
+                        return False
+        # 网络线程运行中时由其负责自动重连，这里只做有限等待
+        self._connect_event.wait(timeout=timeout)
+        return self._is_connected
 
     def send_action(
             self,
             action: str,
             robot_topic: str = "esp32/robot1/sub",
-            params: dict = None
-    ) -> dict:
-        logger.bind(tag=TAG).info(f"发送指令: action={action}, topic={robot_topic}")
+            params: dict = None,
+            qos: int = 0,
+            timeout: float = 2.0
+    ) -> str:
+        """发送指令并等待发布完成，返回执行结果"""
+        info = self.send_action_nowait(action, robot_topic, qos=qos)
+        return self.wait_action(action, info, timeout=timeout)
+
+    def send_action_nowait(
+            self,
+            action: str,
+            robot_topic: str = "esp32/robot1/sub",
+            qos: int = 0
+    ) -> Union[mqtt.MQTTMessageInfo, str]:
+        """发送指令但不等待发布完成，由调用方统一等待，用于批量下发；校验失败时返回错误信息"""
+        log.opt(lazy=True).debug("发送指令(不等待): action={}, topic={}", lambda: action, lambda: robot_topic)
         if not self._is_connected:
-            logger.bind(tag=TAG).error("MQTT未连接")
+            log.error("MQTT未连接")
             return "ERROR：MQTT未连接"
-        if action not in ROBOT_ACTIONS:
-            logger.bind(tag=TAG).error(f"无效动作指令: {action}")
-            return f"ERROR:无效的动作指令{action}"
+        payload = _ACTION_BYTES.get(action)
+        if payload is None:
+            log.error(f"无效动作指令: {action}")
+            return _INVALID_MSG + action
         try:
-            payload = action
-            result = self.client.publish(robot_topic, payload, 1)
-            logger.bind(tag=TAG).info(f"指令已发送: {action}, result={result.rc}")
-            return f"SUCCESS:{action}命令执行成功"
+            return self.client.publish(robot_topic, payload, qos)
         except Exception as e:
-            logger.bind(tag=TAG).error(f"指令发送失败: {str(e)}")
+            log.error(f"指令发送失败: {str(e)}")
+            return f"ERROR:{action}命令执行失败"
+
+    def wait_action(
+            self,
+            action: str,
+            info: Union[mqtt.MQTTMessageInfo, str],
+            timeout: float = 2.0
+    ) -> str:
+        """等待send_action_nowait发出的指令发布完成，返回执行结果"""
+        if isinstance(info, str):
+            # send_action_nowait校验或发送失败，直接返回其错误信息
+            return info
+        try:
+            info.wait_for_publish(timeout=timeout)
+            if not info.is_published():
+                log.error(f"指令发送超时: {action}, mid={info.mid}")
+                return f"ERROR:{action}命令执行超时"
+            log.opt(lazy=True).debug("指令已发送: {}, mid={}", lambda: action, lambda: info.mid)
+            return _SUCCESS_MSGS[action]
+        except Exception as e:
+            log.error(f"指令发送失败: {str(e)}")
             return f"ERROR:{action}命令执行失败"
 
     def disconnect(self):
         if self._is_connected:
-            logger.bind(tag=TAG).info("断开MQTT连接")
+            log.info("断开MQTT连接")
             self.client.disconnect()
-            self.client.loop_stop()
-            self._is_connected = False
+        # 未连接时网络线程可能仍在自动重连，同样需要停止
+        self.client.loop_stop()
+        self._loop_started = False
+        self._is_connected = False
 
 
 # 大模型回调接口
@@ -118,11 +218,7 @@ ROBOT_CONTROL_FUNCTION_DESC = {
             "properties": {
                 "action": {
                     "type": "string",
-                    "enum": [
-                        "forward", "turn_L", "home", "turn_R", "backward",
-                        "hello", "omni_walk", "moonwalk_L", "dance", "up_down",
-                        "push_up", "front_back", "wave_hand", "scared"
-                    ],
+                    "enum": list(RobotAction.__args__),
                     "description": "下面为四足机器人动作指令。每行冒号':'前面为机器人控制指令，后面为指令描述，可以通过中英文或任意自然语言操作机器人。当听到全部或者所有机器人时，特指robot_id为[1,2,3]，机器人ID不能大于3。机器人指令只能为enum列表也就是下面列出的动作指令。"
                                     "forward: 前进,控制机器人向前移动;"
                                     "turn_L: 左转,机器人向左旋转或调整方向;"
@@ -158,20 +254,32 @@ ROBOT_CONTROL_FUNCTION_DESC = {
     }
 }
 
+def _summarize_results(results: dict) -> str:
+    """各机器人结果一致时合并为一条，减少返回给大模型的内容"""
+    unique = set(results.values())
+    if len(unique) == 1:
+        return f"{unique.pop()}(机器人{list(results)})"
+    return str(results)
+
 @register_function('robots_control', ROBOT_CONTROL_FUNCTION_DESC, ToolType.SYSTEM_CTL)
 def robots_control(conn, action: str, robot_id = 1, params: dict = None):
-    logger.bind(tag=TAG).info(f"执行机器人控制: action={action}, robot_id={robot_id}")
+    log.info(f"执行机器人控制: action={action}, robot_id={robot_id}")
     try:
         plugin_config = conn.config["plugins"]["robots_control"]
-        client_id = plugin_config.get("mqtt_client_id", f"robot_{uuid.uuid4()}")
+        client_id = plugin_config.get("mqtt_client_id")
         mqtt_host = plugin_config.get("mqtt_server", "mqtt.xiaozhi.vip")
         mqtt_port = int(plugin_config.get("mqtt_port", 1883))
         mqtt_user = plugin_config.get("mqtt_user")
         mqtt_pass = plugin_config.get("mqtt_password")
+        # 动作指令可重复执行，默认使用QoS 0，省去PUBACK往返
+        qos = int(plugin_config.get("mqtt_qos", 0))
+        # 来自接口的配置可能是字符串，需显式解析，避免"false"被当作开启
+        broadcast = str(plugin_config.get("mqtt_broadcast", False)).lower() in ("true", "1", "yes")
+        keepalive = int(plugin_config.get("mqtt_keepalive", 30))
         log_pass = "***" if mqtt_pass else ""
-        logger.bind(tag=TAG).info(f"MQTT连接: host={mqtt_host}, port={mqtt_port}, user={mqtt_user}, pass={log_pass}")
-        controller = RobotController(client_id, mqtt_host, mqtt_port, mqtt_user, mqtt_pass)
-        if not controller._is_connected:
+        log.info(f"MQTT连接: host={mqtt_host}, port={mqtt_port}, user={mqtt_user}, pass={log_pass}")
+        controller = RobotController(client_id, mqtt_host, mqtt_port, mqtt_user, mqtt_pass, keepalive)
+        if not controller.ensure_connected():
             return ActionResponse(Action.REQLLM,  "MQTT连接失败，请稍后再试。", None)
         if isinstance(robot_id, int):
             robot_ids = [robot_id]
@@ -179,18 +287,34 @@ def robots_control(conn, action: str, robot_id = 1, params: dict = None):
             robot_ids = robot_id
         else:
             return ActionResponse(Action.REQLLM, "robot_id参数类型错误，应为整数或整数列表。", None)
+        invalid_ids = [rid for rid in robot_ids if rid not in ROBOT_TOPICS]
+        if invalid_ids:
+            log.error(f"无效机器人ID: {invalid_ids}")
+            return ActionResponse(Action.REQLLM, f"无效的机器人ID{invalid_ids}，ID只能为{list(ROBOT_TOPICS)}。", None)
+        if broadcast and set(robot_ids) >= ROBOT_TOPICS.keys():
+            # 控制全部机器人时只向广播主题发送一次
+            log.info(f"广播到全部机器人: action={action}")
+            result = controller.send_action(action, ROBOT_BROADCAST_TOPIC, params, qos=qos)
+            results = {rid: result for rid in robot_ids}
+            return ActionResponse(Action.REQLLM, _summarize_results(results), None)
+        log.info(f"发送到机器人{robot_ids}: action={action}")
+        # 先全部发出，再统一等待发布完成，避免逐个往返
+        infos = [
+            (rid, controller.send_action_nowait(action, ROBOT_TOPICS[rid], qos=qos))
+            for rid in robot_ids
+        ]
+        # 所有指令共用一个截止时间，总等待时间不随机器人数量累加
+        deadline = time.monotonic() + 2.0
         results = {}
-        for rid in robot_ids:
-            robot_topic = f"esp32/robot{rid}/sub"
-            logger.bind(tag=TAG).info(f"发送到机器人{rid}: action={action}")
-            result = controller.send_action(action, robot_topic, params)
-            results[rid] = result
-        return ActionResponse(Action.REQLLM, results, None)
+        for rid, info in infos:
+            remaining = max(deadline - time.monotonic(), 0)
+            results[rid] = controller.wait_action(action, info, timeout=remaining)
+        return ActionResponse(Action.REQLLM, _summarize_results(results), None)
     except KeyError as ke:
-        logger.bind(tag=TAG).error(f"配置缺失: {str(ke)}")
+        log.error(f"配置缺失: {str(ke)}")
         return ActionResponse(Action.REQLLM, "缺少必要配置，请检查设置。", None)
     except Exception as e:
-        logger.bind(tag=TAG).error(f"执行机器人控制失败: {str(e)}")
+        log.error(f"执行机器人控制失败: {str(e)}")
         return ActionResponse(Action.REQLLM, "执行机器人控制指令失败", None)
     finally:
-        logger.bind(tag=TAG).info("MQTT连接已关闭")
+        log.info("MQTT连接已关闭")